@@ -2,6 +2,68 @@
 
 import numpy as np
 
+# Numba is optional. When it is installed, the core loops of the filters below
+# are compiled to machine code; otherwise they simply run as Python code.
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        return lambda function: function
+
+# Reasons for which a touch is deleted by the filters below
+_KEPT = 0
+_REPEATED = 1
+_DOUBLE = 2
+
+def sort_touches(touches):
+    """Sorts the touches by start time. Touches with the same start time are
+    common, as every channel that changed in the same row of a _raw.txt file
+    gets the same time. These are sorted by channel, so that the order of the
+    touches (and which one is found first) is always the same."""
+
+    return touches[np.lexsort((touches[:,1], touches[:,2]))]
+
+@njit(cache=True)
+def _mark_repeats(times, durations, channels, repeated_touch_threshold, reason):
+    """Core loop of repeated_touches, operating on the start times (sorted),
+    durations and channels of the touches as separate 1D arrays. Sets the
+    reason of each deleted touch to _REPEATED."""
+
+    n = len(times)
+    if n == 0:
+        return
+
+    # Index of the last touch on each channel that has not been deleted (current)
+    current = np.full(channels.max() + 1, -1, dtype=np.intp)
+
+    # Go through all touches so that first touch comes last, and compare the
+    # start time of each touch against that of the current touch on the same
+    # channel. A deletion never brings two touches closer together than they
+    # already were, so a single pass gives the same result as restarting after
+    # every deletion.
+    for row in range(n - 1, -1, -1):
+        ch = channels[row]
+        previous = current[ch]
+        current[ch] = row
+        if previous < 0:
+            continue
+
+        # If the difference between start times of both touches is
+        # smaller than or equal to the threshold...
+        if times[previous] - times[row] <= repeated_touch_threshold:
+            # And 1) the duration of the current touch is smaller than
+            # that of the earlier one, or 2) it is the start channel (47):
+            if durations[previous] < durations[row] or ch == 47:
+                # Delete the current (=shorter) touch
+                reason[previous] = _REPEATED
+            # Else 1) if the duration of the current touch is greater than
+            # that of the earlier one, or 2) it is the finish channel (0)
+            else:
+                # Delete the earlier (=shorter) touch, the current touch
+                # remains the one to compare against
+                reason[row] = _REPEATED
+                current[ch] = previous
+
 def repeated_touches(touches, repeated_touch_threshold):
     """This function filters out touches on the same electrode channel that
     occur within a certain given amount of time. Usually, repeated touches are
@@ -18,137 +80,146 @@ def repeated_touches(touches, repeated_touch_threshold):
     no_rt: a 2D numpy array containing the filtered individual touch data
     deleted: a 2D numpy array containing the deleted touch data"""
 
-    # Get all channels in which more than 1 touch occured
-    unique, counts = np.unique(touches[:,1], return_counts=True)
-    repeated_touched_channels = [unique[index] for index, count in enumerate(counts) if count > 1]
-
-    # Get a boolean mask of rows of which the channel is in repeated_touched_channels
-    mask = np.in1d(touches[:,1].ravel(), repeated_touched_channels).reshape(touches[:,1].shape)
-
-    # rt is equal to all the rows in touches for which the mask is True
-    rt = touches[mask]
-    rt = rt[np.argsort(rt[:,2])][::-1] # order so that first touch comes last
+    # Make sure the touches are sorted by start time (see sort_touches). Any
+    # selection of rows from touches below is then sorted as well.
+    if np.any(np.diff(touches[:,2]) < 0):
+        touches = sort_touches(touches)
 
-    # no_rt is equal to all the rows in touches for which the mask is False
-    no_rt = touches[~mask]
+    # Count the number of touches on each channel (0-47)
+    channels = touches[:,1].astype(np.intp)
+    counts = np.bincount(channels, minlength=48)
 
-    # Keep an array of all touches that are deleted
-    deleted = np.zeros([0,4])
+    # Get a boolean mask of rows of which the channel has been touched more
+    # than once. Touches on all other channels are always kept.
+    mask = counts[channels] > 1
+    rt_rows = np.flatnonzero(mask)
 
     # For each channel, remove the shortest touch of pairs that follow each
     # other within the repeated_touch_threshold
-    for ch in repeated_touched_channels:
-
-        subarray = rt[np.where(rt[:,1] == ch)]
-        stop = False
-
-        while len(subarray) > 1 and stop == False:
-
-            # While there are still multiple touches left, compare the start
-            # time of each touch against the next one. If a touch is to be
-            # deleted, restart the loop. If no touch is deleted, exit the while
-            # loop
-            for row in range(len(subarray)):
-
-                # If the difference between start times of both touches is
-                # smaller than or equal to the threshold...
-                if subarray[row,2] - subarray[row+1,2] <= repeated_touch_threshold:
-                    # And 1) the duration of the first touch is smaller than
-                    # that of the second one, or 2) it is the start channel (47):
-                    if subarray[row,3] < subarray[row+1,3] or subarray[row,1] == 47:
-                        # Delete the first (=shorter) touch
-                        deleted = np.vstack([deleted, subarray[row]])
-                        subarray = np.delete(subarray,row,0)
-                        # If there is only 1 touch left:
-                        if len(subarray) < 2:
-                            no_rt = np.vstack([no_rt, subarray]) # keep that touch
-                        # Restart the for loop with the updated subarray
-                        break
-                    # Else 1) if the duration of the first touch is greater than
-                    # that of the second one, or 2) it is the finish channel (0)
-                    elif subarray[row,3] >= subarray[row+1,3] or subarray[row,1] == 0:
-                        # Delete the second (=shorter) touch
-                        deleted = np.vstack([deleted, subarray[row+1]])
-                        subarray = np.delete(subarray,row+1,0)
-                        # If there is only 1 touch left:
-                        if np.shape(subarray)[0] < 2:
-                            no_rt = np.vstack([no_rt, subarray]) # keep that touch
-                        # Restart the for loop with the updated subarray
-                        break
-                # If no multiple touches remain and, as a result, the for loop
-                # continued until the last pair of rows:
-                elif row == len(subarray) - 2:
-                    # Add the remaining touches to the no_rt array
-                    no_rt = np.vstack([no_rt, subarray])
-                    # Break the while loop and go to the next channel (in the
-                    # outer for loop)
-                    stop = True
-                    break
+    reason = np.zeros(len(rt_rows), dtype=np.uint8)
+    _mark_repeats(touches[rt_rows,2], touches[rt_rows,3], channels[rt_rows],
+        repeated_touch_threshold, reason)
+    is_deleted = np.zeros(len(touches), dtype=bool)
+    is_deleted[rt_rows] = reason == _REPEATED
 
-    # Restore the initial order of touches
-    no_rt = no_rt[np.argsort(no_rt[:,2])]
-    deleted = deleted[np.argsort(deleted[:,2])]
+    # Select the rows from touches only once, which keeps them in order (also
+    # touches with the same start time)
+    no_rt = touches[~is_deleted]
+    deleted = touches[is_deleted]
 
     return no_rt, deleted
 
-def double_electrode(touches):
+@njit(cache=True)
+def _mark_doubles(times, channels, double_electrode_threshold, reason):
+    """Core loop of double_electrode, operating on the start times (sorted) and
+    channels of the touches as separate 1D arrays. Touches that have already
+    been deleted are skipped. Sets the reason of each deleted touch to _DOUBLE."""
+
+    n = len(times)
+
+    # Go through the touches once. Deleting a touch never creates a new pair of
+    # coinciding touches, so this gives the same result as restarting from the
+    # first touch after every deletion.
+    end = 0
+    for row in range(n):
+
+        # Move the end of the window forward to the first touch that started
+        # more than double_electrode_threshold after the current touch
+        while end < n and times[end] <= times[row] + double_electrode_threshold:
+            end += 1
+        if reason[row] != _KEPT:
+            continue
+
+        # For each other touch within the window, check whether or not the
+        # absolute difference in channel is 2 (e.g. 6 and 4, or 6 and 8). If
+        # true, these electrodes are adjacent along the length of the beam.
+        # The only exceptions are the start (47) and finish (0) electrodes:
+        # the current touch may not be on the finish channel, and the other
+        # touch on neither of both (so a touch on 45 shortly after a touch on
+        # 47 is still deleted, but not one on 45 at the same time, which is
+        # sorted before it).
+        ch_1 = channels[row]
+        for row2 in range(row+1, end):
+            if reason[row2] != _KEPT:
+                continue
+            ch_2 = channels[row2]
+            if abs(ch_1 - ch_2) == 2 and ch_1 != 0 and ch_2 != 0 and ch_2 != 47:
+
+                # If so, delete the touch(es) corresponding to the lowest
+                # channel number (e.g the one closest to the finish)
+                if ch_1 < ch_2:
+                    reason[row] = _DOUBLE
+                    break
+                else:
+                    reason[row2] = _DOUBLE
+
+@njit(cache=True)
+def _apply_filters(times, durations, channels, repeated_touch_threshold,
+    double_electrode_threshold):
+    """Core loop of apply_filters. Returns the reason why each touch is deleted
+    (_REPEATED or _DOUBLE), or _KEPT if it is not deleted."""
+
+    reason = np.zeros(len(times), dtype=np.uint8)
+    _mark_repeats(times, durations, channels, repeated_touch_threshold, reason)
+    _mark_doubles(times, channels, double_electrode_threshold, reason)
+
+    return reason
+
+def double_electrode(touches, double_electrode_threshold = 0.150):
     """This function filters out touches that occured shortly after each other
     on two adjacent electrode channels, which indicates that a mouse put its
     paw onto both electrodes (almost) simultaneously. In most cases, this is a
     single touch and so it should not count as two foot faults. The touch to
     be deleted is the one closest to the narrow end of the beam.
 
-    Input argument
+    Input arguments
     touches: a 2D numpy array containing the individual touch data
+    double_electrode_threshold: the threshold (in seconds) that determines how
+    close in time touches onto adjacent channels have to be in order to be
+    filtered out (150 ms by default)
 
     Output
     no_de: a 2D numpy array containing the filtered individual touch data
     deleted: a 2D numpy array containing the deleted touch data"""
 
-    # Keep an array of all touches that are deleted
-    deleted = np.zeros([0,4])
-
-    while True:
-
-        touch_deleted = False
-        # For each touch, obtain an array of other touches that started within
-        # 150 ms after the start of that touch
-        for row in range(len(touches)):
-            # Select all touches after the current one
-            subarray = touches[row+1:]
-            # Keep all touches that started at or before 150 ms after current touch
-            within_time = subarray[np.where(subarray[:,2] <= touches[row][2] + 0.150)]
-
-            # For each touch in the array, check whether or not the absolute
-            # difference in channel is 2 (e.g. 6 and 4, or 6 and 8). If true,
-            # these electrodes are adjacent along the length of the beam.
-            # The only exceptions are the start and finish electrodes.
-            for row2 in range(len(within_time)): # only loops if within_time is not null
-                ch_1 = touches[row][1]
-                ch_2 = within_time[row2][1]
-                if abs(ch_1 - ch_2) == 2 and (ch_1 and ch_2 not in [0,47]):
-
-                    # If so, delete the touch(es) corresponding to the lowest
-                    # channel number (e.g the one closest to the finish)
-                    if ch_1 < ch_2:
-                        deleted = np.vstack([deleted, touches[row]])
-                        touches = np.delete(touches, row, 0)
-                        touch_deleted = True
-                        break
-                    else:
-                        deleted = np.vstack([deleted, within_time[row2]])
-                        touches = np.delete(touches, row+row2+1, 0)
-                        touch_deleted = True
-                        break
-
-            # If a touch has been deleted during the inner loop,
-            # break from the outer loop as well and restart with updated array
-            if touch_deleted == True:
-                break
-
-        # 4. Keep looping until no touch has been deleted anymore
-        if touch_deleted == False:
-            no_de = touches
-            break
-
-    return no_de, deleted
+    # Make sure the touches are sorted by start time (see sort_touches)
+    if np.any(np.diff(touches[:,2]) < 0):
+        touches = sort_touches(touches)
+
+    # Get a boolean mask of all touches that started within the threshold after
+    # a touch on an adjacent channel and are to be deleted
+    reason = np.zeros(len(touches), dtype=np.uint8)
+    _mark_doubles(touches[:,2], touches[:,1].astype(np.intp),
+        double_electrode_threshold, reason)
+    deleted = reason == _DOUBLE
+    no_de = touches[~deleted]
+
+    return no_de, touches[deleted]
+
+def apply_filters(touches, repeated_touch_threshold, double_electrode_threshold = 0.150):
+    """This function applies both filters above in a single call: first
+    repeated_touches, and then double_electrode on the touches that remain.
+    The touches are still checked in two passes (one for each filter), but
+    they are sorted only once and no intermediate arrays are created. The
+    result is the same as calling both functions one after the other.
+
+    Input arguments
+    touches: a 2D numpy array containing the individual touch data
+    repeated_touch_threshold: see repeated_touches
+    double_electrode_threshold: see double_electrode
+
+    Output
+    filtered: a 2D numpy array containing the filtered individual touch data
+    repeated: a 2D numpy array containing the touch data deleted as repeated
+    touches
+    double: a 2D numpy array containing the touch data deleted as touches on
+    two adjacent electrodes"""
+
+    # Make sure the touches are sorted by start time (see sort_touches)
+    if np.any(np.diff(touches[:,2]) < 0):
+        touches = sort_touches(touches)
+
+    reason = _apply_filters(touches[:,2], touches[:,3], touches[:,1].astype(np.intp),
+        repeated_touch_threshold, double_electrode_threshold)
+
+    return touches[reason == _KEPT], touches[reason == _REPEATED], touches[reason == _DOUBLE]
@@ -26,185 +26,150 @@ _touches.txt files.
 # Import the necessary modules
 import argparse, glob, os, sys
 import numpy as np
-from decimal import Decimal, ROUND_HALF_UP
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from functools import partial
+import filters
 
-# Set up argparse
-parser = argparse.ArgumentParser()
-parser.add_argument('input', help = 'filename or folder containing input data \
-(*_raw.txt)',
-type = str)
-touch_filter = parser.add_mutually_exclusive_group(required=False)
-touch_filter.add_argument('-t', '--threshold', help = 'exclude touches of which the \
-duration is shorter than a specified duration (in s)',
-type = float)
-touch_filter.add_argument('-nf', '--no_filter', help = 'do not exclude any \
-touches, even if they may belong to the same foot fault',
-action = 'store_true')
-args = parser.parse_args()
-
-# Check that the input arguments make sense
-if args.input[-8:] == '_raw.txt' and os.path.isfile(args.input):
-    # Input argument is a single file
-    file_list = [args.input]
-elif os.path.isdir(args.input):
-    # Input argument is a folder
-    # Add a forward slash if not already provided
-    if args.input[-1] != '/':
-        args.input += '/'
-    # Add all files ending in _raw.txt to file_list
-    file_list = glob.glob('{}*_raw.txt'.format(args.input))
-    if not file_list:
-        print('Error: No *_raw.txt files found in input folder.')
-        sys.exit()
-else:
-    print('Error: Input file or folder does not exist.')
-    sys.exit()
-
-# Define a threshold; touches with a duration shorter than this threshold will
-# be filtered out
-if args.threshold:
-    threshold = args.threshold
-    if args.threshold > 0.1:
-        print('Warning: threshold option is set at {} s. This may \
-        accidentally exclude many foot faults.'.format(args.threshold))
-# If threshold is not defined by the user, use 0.1 s as threshold but do not
-# actually filter out shorter touches (give warnings instead)
-else:
-    threshold = 0.1
-
-# Extract the path from the filename(s) if this was included in args.input
-slashes = [i for i, c in enumerate(args.input) if c == '/']
-if slashes:
-    path = args.input[:max(slashes)+1]
-else:
-    path = ''
-# Create an alphabetically sorted list of files for processing
-file_list = sorted([filename[len(path):] for filename in file_list])
-
-# Make a logger that writes all warnings and filtered touches to a log.txt file
-def log(msg, path, *args): # *args: filename, channel, time, duration, threshold
-    date = datetime.now().strftime('%Y%m%d')
-    file_out = path + 'log.txt'
+# Format a time or duration (in s) with millisecond precision for the log file
+def round_ms(x):
+    return '{:.3f}'.format(x)
+
+# Make a logger that adds all warnings and filtered touches of a file to
+# log_buf, which is written to a log.txt file once the file has been processed
+# (the date is added to each message at that point)
+def log(log_buf, msg, *args): # *args: filename, channel, time, duration, threshold
     if msg == 'warning':
-        output = '{} {}: Warning! Touch on ch{} at time = {} s has duration {} s.\n'.format(date, *args)
+        output = '{}: Warning! Touch on ch{} at time = {} s has duration {} s.\n'.format(*args)
     elif msg == 'delete':
-        output = '{} {}: Deleted short touch on ch{} at time = {} s with duration {} s (threshold set at {} s).\n'.format(date, *args)
+        output = '{}: Deleted short touch on ch{} at time = {} s with duration {} s (threshold set at {} s).\n'.format(*args)
     elif msg == 'repeated':
-        output = '{} {}: Deleted repeated touch on ch{} at time = {} s with duration {} s.\n'.format(date, *args)
+        output = '{}: Deleted repeated touch on ch{} at time = {} s with duration {} s.\n'.format(*args)
     elif msg == 'double':
-        output = '{} {}: Deleted touch on ch{} at time {} s coinciding within 150 ms with a touch on ch{}.\n'.format(date, *args)
+        output = '{}: Deleted touch on ch{} at time {} s coinciding within 150 ms with a touch on ch{}.\n'.format(*args)
     else:
-        output = '{} {}: {}'.format(date,filename,msg)
-    with open(file_out,'a') as f:
-        f.write(output)
+        output = '{}: {}'.format(args[0],msg)
+    log_buf.append(output)
 
-# Process the _raw.txt file(s)
-for filename in file_list:
+# Process a single _raw.txt file
+def process_file(filename, path, threshold, args):
+    """Convert the filename _raw.txt file (in folder path) to a _touches.txt
+    file. Returns the number of MPR121 sensors in the file and the messages to
+    be written to log.txt."""
 
-    # Force import as 2D array in case no touch was recorded
-    # (i.e., only a single row in _raw.txt file)
-    temp_data = np.array(np.genfromtxt(path+filename,delimiter=','),ndmin=2)
-    if np.shape(temp_data)[0] <= 1:
+    log_buf = [] # Log messages for this file
+
+    # Import the data only once, forced as 2D array in case no touch was
+    # recorded (i.e., only a single row in _raw.txt file)
+    data = np.loadtxt(path+filename,delimiter=',',ndmin=2)
+    if np.shape(data)[0] <= 1:
         # This should not happen as for each successful trial at least the
         # start and finish electrodes should have been touched
         print('Error processing {}: No touches detected.'.format(filename))
         sys.exit(1)
     # Number of MPR121s sensors, in case less than 4 sensors were used
-    n_MPR121s = np.shape(temp_data)[1] - 1
-
-    # Now re-import the data from the _raw.txt file using the right data types
-    data = np.genfromtxt(path+filename,delimiter=',',
-    dtype='float'+ n_MPR121s*',int')
+    n_MPR121s = np.shape(data)[1] - 1
     nrows = len(data)
-    ncols =  n_MPR121s*12+1
-    newdata = np.zeros((nrows,ncols))
+    n_channels = n_MPR121s*12
     start_ch = 47
     finish_ch = 0
 
-    # Rearrange the data to show the touch status for each channel individually
-    for row in range(nrows):
-        newdata[row][0] = data[row][0] # Copy timestamp to the new data array
-        touch_list = []
-        for MPR121 in range(n_MPR121s):
-            # Convert touch status to list of integers with values 0 or 1
-            touch_list.extend(list(reversed(
-            [int(d) for d in str(format(data[row][MPR121+1],'#014b')[2:])])))
-        newdata[row][1:ncols] = touch_list # Paste the list to new data array
+    # Rearrange the data to show the touch status for each channel individually,
+    # stored separately from the timestamps as a (nrows, n_channels) array of
+    # 0 or 1 values (1 byte each)
+    t = data[:,0]
+    # The touch status of each sensor is a 12-bit integer, in which bit n is the
+    # status of channel n. Unpack the bits of all rows and sensors at once: as
+    # big-endian bytes, np.unpackbits gives bits 15 to 0 of each status.
+    bits = np.unpackbits(data[:,1:].astype('>u2').view(np.uint8).reshape(nrows,n_MPR121s,2), axis=2)
+    bits = bits[:,:,:3:-1].reshape(nrows,n_channels) # Bits 0 to 11
 
-    touches = np.zeros((0,4)) # Empty array to be filled with touch data
-    temp = {} # Container to store the touched channels and starting times
-    start = newdata[0][0] # Start time relative to start of data collection
+    touch_rows = [] # Empty list to be filled with touch data
+    # Container to store the starting time of the touch on each channel (-1 if
+    # the channel is not touched)
+    touch_start = np.full(n_channels, -1.0)
+    start = t[0] # Start time relative to start of data collection
 
     # Check that no electrodes were touched during the first measurement
-    if sum(newdata[0][1:ncols]) != 0:
+    if bits[0].any():
         print('Error processing {}: One or more sensors were touched during \
         start of data collection. Please check the raw data file and try again.\
         '.format(filename))
         sys.exit(1)
 
-    # For each touch, calculate time relative to first touch and the duration
-    # Exclude the first row here (which should be empty except for time)
-    for row in range(1,nrows):
-
-        for ch in range(ncols-1):
-
-            include_touch = True # By default, include all touches
-            if newdata[row][ch+1] == 1 and newdata[row-1][ch+1] == 0: # Touched
-                if row == 1 and ch != start_ch:
-                    msg = ('Warning! First touch was recorded on channel {}.\n'.format(ch))
-                    log(msg, path, filename)
-
-                time = newdata[row][0] - start
-
-                # Keep the channel and time of each touch until until the
-                # corresponding touch is released and duration can be calculated
-                temp.update({ch:time})
-
-            elif newdata[row][ch+1] == 0 and newdata[row-1][ch+1] == 1: # Touch released
-                released = newdata[row][0] - start
-                duration = released - temp[ch]
-                if duration < threshold and finish_ch < ch < start_ch:
-                    log_ch = int(ch)
-                    log_time = Decimal(str(temp[ch])).quantize(Decimal('.001'), rounding=ROUND_HALF_UP)
-                    log_dur = Decimal(str(duration)).quantize(Decimal('.001'), rounding=ROUND_HALF_UP)
-                    if args.threshold:
-                        log('delete', path, filename, log_ch, log_time, log_dur, threshold)
-                        include_touch = False
-                    else:
-                        log('warning', path, filename, log_ch, log_time, log_dur)
-                if include_touch:
-                    touches = np.vstack([touches,[0,ch,temp[ch],duration]])
-                del temp[ch]
-
-    # Sort the touches by starting time
-    touches = touches[np.argsort(touches[:,2])]
+    # Compare each row with the previous one to find the channels that were
+    # touched (1) or released (-1) at that row. The first row is excluded here
+    # (which should be empty except for time)
+    edges = np.diff(bits.view(np.int8), axis=0)
+
+    # For each touch, calculate time relative to first touch and the duration.
+    # Only the rows and channels at which the touch status changed are visited,
+    # in the same order as going through all channels of each row.
+    for row, ch in np.argwhere(edges != 0):
+        row += 1 # Row in t and bits
+
+        include_touch = True # By default, include all touches
+        if edges[row-1][ch] == 1: # Touched
+            if row == 1 and ch != start_ch:
+                msg = ('Warning! First touch was recorded on channel {}.\n'.format(ch))
+                log(log_buf, msg, filename)
+
+            time = t[row] - start
+
+            # Keep the time of each touch until until the corresponding
+            # touch is released and duration can be calculated
+            touch_start[ch] = time
+
+        else: # Touch released
+            released = t[row] - start
+            time = touch_start[ch]
+            duration = released - time
+            if duration < threshold and finish_ch < ch < start_ch:
+                log_ch = int(ch)
+                log_time = round_ms(time)
+                log_dur = round_ms(duration)
+                if args.threshold:
+                    log(log_buf, 'delete', filename, log_ch, log_time, log_dur, threshold)
+                    include_touch = False
+                else:
+                    log(log_buf, 'warning', filename, log_ch, log_time, log_dur)
+            if include_touch:
+                touch_rows.append((0, ch, time, duration))
+            touch_start[ch] = -1.0
+
+    # Convert the touch data to a 2D array (also if no touches were recorded)
+    touches = np.array(touch_rows, dtype=np.float64).reshape(-1,4)
+
+    # Sort the touches by starting time, and touches with the same starting
+    # time by channel. The filters keep this order.
+    touches = filters.sort_touches(touches)
 
     # Filter out touches that likely belong to the same foot fault
     if not args.no_filter:
-        import filters
 
-        # Delete any touches that occur on the same channel within 0.150 s
-        touches, deleted = filters.repeated_touches(touches, repeated_touch_threshold = 0.150)
-        if deleted.any():
-            for index, row in enumerate(deleted):
+        # Delete any touches that occur on the same channel within 0.150 s, and
+        # also any touches that occur almost simultaneously on two adjacent
+        # channels (both filters are applied in a single call, without
+        # creating the intermediate array of touches between them)
+        touches, repeated, double = filters.apply_filters(touches,
+            repeated_touch_threshold = 0.150, double_electrode_threshold = 0.150)
+        if repeated.any():
+            for index, row in enumerate(repeated):
                 log_ch = int(row[1])
-                log_time = Decimal(str(row[2])).quantize(Decimal('.001'), rounding=ROUND_HALF_UP)
-                log_dur = Decimal(str(row[3])).quantize(Decimal('.001'), rounding=ROUND_HALF_UP)
-                log('repeated', path, filename, log_ch, log_time, log_dur)
-
-        # Also delete any touches that occur almost simultaneously on two adjacent channels
-        touches, deleted = filters.double_electrode(touches)
-        if deleted.any():
-            for index, row in enumerate(deleted):
+                log_time = round_ms(row[2])
+                log_dur = round_ms(row[3])
+                log(log_buf, 'repeated', filename, log_ch, log_time, log_dur)
+
+        if double.any():
+            for index, row in enumerate(double):
                 log_ch = int(row[1])
-                log_time = Decimal(str(row[2])).quantize(Decimal('.001'), rounding=ROUND_HALF_UP)
-                log_dur = Decimal(str(row[3])).quantize(Decimal('.001'), rounding=ROUND_HALF_UP)
-                log('double', path, filename, log_ch, log_time, log_ch+2)
+                log_time = round_ms(row[2])
+                log_dur = round_ms(row[3])
+                log(log_buf, 'double', filename, log_ch, log_time, log_ch+2)
 
     # Give each touch an index
     touch_numbers = len(touches)
-    touches[:,0] = [d+1 for d in range(touch_numbers)]
+    touches[:,0] = np.arange(1, touch_numbers+1)
 
     # Change the filename to touches_filtered.txt if filtering was done and save
     if args.no_filter:
@@ -212,9 +177,110 @@ for filename in file_list:
     else:
         touches_filename = '{}{}_touches.txt'.format(path,filename[:-8])
     hdr_touches = 'touch,ch,time,duration'
-    np.savetxt(touches_filename, touches, fmt='%i,%i,%.3f,%.3f',newline='\n',header=hdr_touches,comments='')
+    # Format all rows at once (from Python floats rather than numpy values) and
+    # write the file in a single call
+    lines = ['%i,%i,%.3f,%.3f' % tuple(row) for row in touches.tolist()]
+    with open(touches_filename,'w') as f:
+        f.write('\n'.join([hdr_touches] + lines) + '\n')
+
+    return n_MPR121s, log_buf
+
+# Write the log messages of a file to the log.txt file in path, adding the date
+# to each message
+def write_log(path, log_buf):
+    if log_buf:
+        date = datetime.now().strftime('%Y%m%d')
+        with open(path + 'log.txt','a') as f:
+            f.writelines('{} {}'.format(date, output) for output in log_buf)
+
+def main():
+
+    # Set up argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input', help = 'filename or folder containing input data \
+    (*_raw.txt)',
+    type = str)
+    touch_filter = parser.add_mutually_exclusive_group(required=False)
+    touch_filter.add_argument('-t', '--threshold', help = 'exclude touches of which the \
+    duration is shorter than a specified duration (in s)',
+    type = float)
+    touch_filter.add_argument('-nf', '--no_filter', help = 'do not exclude any \
+    touches, even if they may belong to the same foot fault',
+    action = 'store_true')
+    args = parser.parse_args()
+
+    # Check that the input arguments make sense
+    if args.input[-8:] == '_raw.txt' and os.path.isfile(args.input):
+        # Input argument is a single file
+        file_list = [args.input]
+    elif os.path.isdir(args.input):
+        # Input argument is a folder
+        # Add a forward slash if not already provided
+        if args.input[-1] != '/':
+            args.input += '/'
+        # Add all files ending in _raw.txt to file_list
+        file_list = glob.glob('{}*_raw.txt'.format(args.input))
+        if not file_list:
+            print('Error: No *_raw.txt files found in input folder.')
+            sys.exit()
+    else:
+        print('Error: Input file or folder does not exist.')
+        sys.exit()
+
+    # Define a threshold; touches with a duration shorter than this threshold will
+    # be filtered out
+    if args.threshold:
+        threshold = args.threshold
+        if args.threshold > 0.1:
+            print('Warning: threshold option is set at {} s. This may \
+            accidentally exclude many foot faults.'.format(args.threshold))
+    # If threshold is not defined by the user, use 0.1 s as threshold but do not
+    # actually filter out shorter touches (give warnings instead)
+    else:
+        threshold = 0.1
+
+    # Extract the path from the filename(s) if this was included in args.input
+    slashes = [i for i, c in enumerate(args.input) if c == '/']
+    if slashes:
+        path = args.input[:max(slashes)+1]
+    else:
+        path = ''
+    # Create an alphabetically sorted list of files for processing
+    file_list = sorted([filename[len(path):] for filename in file_list])
+
+    # Process the _raw.txt file(s), in parallel if there is more than one file.
+    # The log messages are written here, in the same order as the files.
+    process = partial(process_file, path=path, threshold=threshold, args=args)
+    if len(file_list) > 1:
+        error = None
+        with ProcessPoolExecutor() as executor:
+            futures = [executor.submit(process, filename) for filename in file_list]
+            for future in futures:
+                if future.cancelled():
+                    continue
+                try:
+                    n_MPR121s, log_buf = future.result()
+                except (Exception, SystemExit) as e:
+                    # Do not start on any more files after an error. Files that
+                    # are already being processed are finished, and their log
+                    # messages are still written, so that no _touches.txt file
+                    # is left without its warnings in log.txt.
+                    if error is None:
+                        error = e
+                        for other in futures:
+                            other.cancel()
+                    continue
+                write_log(path, log_buf)
+        if error is not None:
+            raise error
+    else:
+        n_MPR121s, log_buf = process(file_list[0])
+        write_log(path, log_buf)
+
+    if len(file_list) > 1:
+        print('\nDone processing {} files.'.format(len(file_list)))
+    else:
+        print('\nProcessed {} with {} MPR121 sensor(s) ({} channels).'.format(path+file_list[0], n_MPR121s, n_MPR121s*12))
 
-if len(file_list) > 1:
-    print('\nDone processing {} files.'.format(len(file_list)))
-else:
-    print('\nProcessed {} with {} MPR121 sensor(s) ({} channels).'.format(path+filename, n_MPR121s, n_MPR121s*12))
+if __name__ == '__main__':
+    main()
@@ -12,44 +12,95 @@ by an integer representing the number of trials to include. A different output
 filename can be chosen by using the -o option followed by the desired output
 filename (without .txt extension)."""
 
-import os, glob, sys, argparse
+import os, sys, argparse
 import numpy as np
-from datetime import datetime, timedelta
-from decimal import Decimal, ROUND_HALF_UP
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
 
 # Some variables to define
 start_ch = 47
 finish_ch = 0
 
-# Set up argparse
-parser = argparse.ArgumentParser()
-parser.add_argument('-o', '--out', help = 'output filename (without extension)', type = str)
-parser.add_argument('-t', '--trials', help = 'number of trials', type = int)
-parser.add_argument('-m', '--manual', help = 'input each data folder manually', action = 'store_true')
-args = parser.parse_args()
-
-# Check optional arguments
-if args.trials:
-    trials = args.trials
-else:
-    trials = 3
-if args.out:
-    out = args.out
-else:
-    out = 'summary'
-if os.path.isfile('data/{}.txt'.format(out)):
-    while True:
-        overwrite = input('Output file already exists, do you want to delete the existing file now? [y/n] ').lower()
-        if overwrite not in ('y', 'n'):
-            print('Invalid answer, please try again.')
-        elif overwrite == 'y':
-            print('Continuing: data/{}.txt has been deleted'.format(out))
-            os.remove('data/{}.txt'.format(out))
-            os.remove('data/{}_log.txt'.format(out))
-            break
-        elif overwrite == 'n':
-            input('Exiting.')
-            sys.exit(1)
+# The per-trial statistics below are compiled with Numba if it is installed,
+# and run as plain Python code if not
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        return lambda function: function
+
+# Status of the traversion time of a trial, which determines the log message
+_COMPLETE = 0
+_NO_START = 1
+_NO_FINISH = 2
+_LATE_TOUCH = 3
+
+@njit(cache=True)
+def _trial_stats(channels, times, durations, start_ch, finish_ch):
+    """Calculates the following for the touches of a single trial, given the
+    channels, start times (sorted) and durations of the touches as separate 1D
+    arrays:
+    1) total number of foot faults (= left + right)
+    2) total number of right-sided foot faults
+    3) total number of left-sided foot faults
+    4) traversion time
+    5) time to first foot fault
+    6) distance to first foot fault
+    Returns left, right, the status of the traversion time, and 4), 5) and 6).
+    Undefined times are nan, and an undefined distance is -1."""
+
+    # Go through all touches once
+    left = 0
+    right = 0
+    start_time = np.nan
+    finish_time = np.nan
+    last_finish = -1
+    first_fault = -1
+    for row in range(len(channels)):
+        ch = channels[row]
+        if ch == start_ch:
+            # Take the last touch recorded on start_ch
+            start_time = times[row]
+        elif ch == finish_ch:
+            # Take the release time of the first touch recorded on finish_ch
+            # (= touch time + duration)
+            if last_finish < 0:
+                finish_time = times[row] + durations[row]
+            last_finish = row
+        elif finish_ch < ch < start_ch:
+            # 1), 2), and 3): number of (lateralized) foot faults
+            if first_fault < 0:
+                first_fault = row
+            if ch % 2 == 0: # If ch is even (and excluding the start & finish channels)
+                right += 1
+            else: # If ch is odd (and exluding the start & finish channels)
+                left += 1
+
+    # 4) Calculate the traversion time, by substracting the time of the last touch
+    # (finish_ch) from the first touch (start_ch)
+    trav_time = np.nan
+    if np.isnan(start_time):
+        status = _NO_START
+    elif last_finish < 0:
+        status = _NO_FINISH
+    else:
+        trav_time = finish_time - start_time
+        # If another channel was touched after release of finish_ch
+        # (perhaps by a tail or by the investigator):
+        if times[last_finish] + durations[last_finish] < times[len(times)-1]:
+            status = _LATE_TOUCH
+        else:
+            status = _COMPLETE
+
+    # 5) and 6): Time and distance to first foot fault. If start time was not
+    # recorded, time to first foot fault is not defined.
+    time_to_first_fault = np.nan
+    dist_to_first_fault = -1
+    if first_fault >= 0:
+        time_to_first_fault = times[first_fault] - start_time
+        dist_to_first_fault = 100 - (channels[first_fault] // 2) * 4
+
+    return left, right, status, trav_time, time_to_first_fault, dist_to_first_fault
 
 # Ask for input arguments
 def is_number(s):
@@ -59,213 +110,234 @@ def is_number(s):
     except ValueError:
         return False
 
-if args.manual:
-    while True:
-        folders = input('Enter data folders to include, separated by spaces: ').split()
-        for folder in folders:
-            if len(folder) != 8 or is_number(folder) == False:
-                print("Error in folder name '{}': format should be YYYYMMDD. Please try again.".format(folder))
-                folders = []
-        if folders:
-            break
-
-else:
-    while True:
-        start_date = input('First data folder to include: ')
-        if len(start_date) != 8 or is_number(start_date) == False:
-            print('Format should be YYYYMMDD. Please try again.')
-        else:
-            start_date = datetime.strptime(start_date,"%Y%m%d")
-            break
-
-    while True:
-        num_folders = input('Total number of data folders to include: ')
-        if is_number(num_folders) == False:
-            print('Input should be a number. Please try again.')
-        else:
-            num_folders = int(num_folders)
-            break
-
-    while True:
-        interval = input('Interval between data folders: ')
-        if is_number(interval) == False:
-            print('Input should be a number. Please try again.')
-        else:
-            interval = int(interval)
-            break
+# Make a logger that adds all warnings of a trial to log_buf, which is written
+# to the log file once the trial has been summarized
+def log(log_buf, folder, subject, trial, msg):
+    output = '{}/{}_{:03d}: {}'.format(folder, subject, trial, msg)
+    log_buf.append(output)
+
+# Read the channels, start times and durations of the touches in a _touches.txt
+# file (skipping the header and touch numbers) as separate 1D arrays. A file
+# without any touches gives empty arrays.
+def read_touches(filename):
+    with open(filename) as f:
+        lines = f.read().splitlines()[1:]
+    if not lines:
+        return np.empty(0, dtype=np.intp), np.empty(0), np.empty(0)
+    touches = np.loadtxt(lines, delimiter=',', usecols=(1,2,3), ndmin=1,
+        dtype=[('ch', np.intp), ('time', np.float64), ('duration', np.float64)])
+    return (np.ascontiguousarray(touches['ch']), np.ascontiguousarray(touches['time']),
+        np.ascontiguousarray(touches['duration']))
+
+# Calculate the summary statistics of a single trial. Returns these as a
+# comma-separated string, together with the log messages of the trial.
+def summarize_trial(task):
+    folder, subject, trial = task
+    log_buf = []
+
+    # Read corresponding _touches.txt file
+    filename = 'data/{}/{}_{:03d}_touches.txt'.format(folder,subject,trial+1)
+    channels, times, durations = read_touches(filename)
+
+    # Calculate the summary statistics of the trial. A trial without any
+    # touches has no foot faults and no start touch, so skip the calculations.
+    if len(channels) == 0:
+        left, right, status, trav_time, time_to_first_fault, dist_to_first_fault = 0, 0, _NO_START, np.nan, np.nan, -1
+    else:
+        left, right, status, trav_time, time_to_first_fault, dist_to_first_fault = _trial_stats(
+            channels, times, durations, start_ch, finish_ch)
+    total = left + right
+
+    if status == _NO_START:
+        msg = 'No touch recorded on channel {}. Could not calculate traversion time.\n'.format(start_ch)
+        log(log_buf, folder, subject, trial, msg)
+    elif status == _NO_FINISH:
+        msg = 'No touch recorded on channel {}. Could not calculate traversion time.\n'.format(finish_ch)
+        log(log_buf, folder, subject, trial, msg)
+    elif status == _LATE_TOUCH:
+        msg = 'At least one other channel was touched after channel {} was released. Calculation of traversion time may be incorrect.\n'.format(finish_ch)
+        log(log_buf, folder, subject, trial, msg)
+
+    # Convert the results to strings, using 'nan' for undefined results
+    if np.isnan(trav_time):
+        trav_time = 'nan'
+    else:
+        trav_time = str(trav_time)
+    if np.isnan(time_to_first_fault):
+        time_to_first_fault = 'nan'
+    else:
+        time_to_first_fault = '{:.3f}'.format(time_to_first_fault)
+    if dist_to_first_fault < 0:
+        dist_to_first_fault = 'nan'
+    else:
+        dist_to_first_fault = str(dist_to_first_fault)
+
+    return ','.join((str(total),str(left),str(right),trav_time,time_to_first_fault,dist_to_first_fault)), log_buf
+
+def main():
+
+    # Set up argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o', '--out', help = 'output filename (without extension)', type = str)
+    parser.add_argument('-t', '--trials', help = 'number of trials', type = int)
+    parser.add_argument('-m', '--manual', help = 'input each data folder manually', action = 'store_true')
+    args = parser.parse_args()
+
+    # Check optional arguments
+    if args.trials:
+        trials = args.trials
+    else:
+        trials = 3
+    if args.out:
+        out = args.out
+    else:
+        out = 'summary'
+    if os.path.isfile('data/{}.txt'.format(out)):
+        while True:
+            overwrite = input('Output file already exists, do you want to delete the existing file now? [y/n] ').lower()
+            if overwrite not in ('y', 'n'):
+                print('Invalid answer, please try again.')
+            elif overwrite == 'y':
+                print('Continuing: data/{}.txt has been deleted'.format(out))
+                os.remove('data/{}.txt'.format(out))
+                os.remove('data/{}_log.txt'.format(out))
+                break
+            elif overwrite == 'n':
+                input('Exiting.')
+                sys.exit(1)
+
+    if args.manual:
+        while True:
+            folders = input('Enter data folders to include, separated by spaces: ').split()
+            for folder in folders:
+                if len(folder) != 8 or is_number(folder) == False:
+                    print("Error in folder name '{}': format should be YYYYMMDD. Please try again.".format(folder))
+                    folders = []
+            if folders:
+                break
+
+    else:
+        while True:
+            start_date = input('First data folder to include: ')
+            if len(start_date) != 8 or is_number(start_date) == False:
+                print('Format should be YYYYMMDD. Please try again.')
+            else:
+                start_date = date(int(start_date[:4]), int(start_date[4:6]), int(start_date[6:])).toordinal()
+                break
 
-    all_dates = [start_date + timedelta(interval)*i for i in range(num_folders)]
-    folders = [date.strftime("%Y%m%d") for date in all_dates]
+        while True:
+            num_folders = input('Total number of data folders to include: ')
+            if is_number(num_folders) == False:
+                print('Input should be a number. Please try again.')
+            else:
+                num_folders = int(num_folders)
+                break
 
-print('\nIncluding the following folders with {} trials per day: {}.'.format(trials,', '.join(folders)))
-input('Press Enter to continue...')
+        while True:
+            interval = input('Interval between data folders: ')
+            if is_number(interval) == False:
+                print('Input should be a number. Please try again.')
+            else:
+                interval = int(interval)
+                break
 
-# Get all the different subjects in each folder
-unique_subjects = {}
-all_subjects = []
-for folder in folders:
-    file_list = glob.glob('data/{}/*_touches.txt'.format(folder))
-    subjects_found = [path[14:-16] for path in file_list]
-    unique_subjects[folder] = list(set(subjects_found))
-    all_subjects += subjects_found
+        # Dates are counted in days (as ordinals), one interval apart
+        folders = [date.fromordinal(start_date + interval*i).strftime("%Y%m%d") for i in range(num_folders)]
 
-unique_subjects['total'] = list(set(all_subjects))
+    print('\nIncluding the following folders with {} trials per day: {}.'.format(trials,', '.join(folders)))
+    input('Press Enter to continue...')
 
-# Check whether all unique subjects are found in all folders
-subjects_complete = []
-subjects_incomplete = {}
+    # List the _touches.txt files in each folder once, and get all the different
+    # subjects in each folder from these
+    files_in_folder = {}
+    unique_subjects = {}
+    for folder in folders:
+        if os.path.isdir('data/{}'.format(folder)):
+            file_list = [name for name in os.listdir('data/{}'.format(folder)) if name.endswith('_touches.txt')]
+        else:
+            file_list = []
+        files_in_folder[folder] = set(file_list)
+        unique_subjects[folder] = {name[:-16] for name in file_list}
 
-# For all subjects in total:
-# Check if subject exist in folder for all folders
-# If doesn't exist in a folder, put that info in subjects_incomplete and add 'missing' flag
-# If subject doesn't have 'missing' flag, add it to subjects_complete
+    unique_subjects['total'] = set().union(*(unique_subjects[folder] for folder in folders))
 
-for subject in unique_subjects['total']:
-    complete = True
+    # Check whether all unique subjects are found in all folders: complete
+    # subjects are found in every folder, and for each folder the subjects
+    # that are missing are put in subjects_incomplete
+    subjects_complete = sorted(unique_subjects['total'].intersection(*(unique_subjects[folder] for folder in folders)))
+    subjects_incomplete = {}
     for folder in folders:
-        if subject not in unique_subjects[folder]:
-            complete = False
-            if folder in subjects_incomplete:
-                subjects_incomplete[folder].append(subject)
-            else:
-                subjects_incomplete[folder] = [subject]
-    if complete == True:
-        subjects_complete.append(subject)
-
-subjects_complete.sort()
-subjects_incomplete = sorted(subjects_incomplete.items())
-
-if not subjects_complete:
-    print('\nError: could not find subjects with data for all dates specified.')
-    sys.exit(1)
-
-if subjects_incomplete:
-    print('\nWarning: the following subject(s) could not be found:')
-    for m in range(len(subjects_incomplete)):
-        folder = subjects_incomplete[m][0]
-        print('{}: {}'.format(folder,', '.join(subjects_incomplete[m][1])))
+        missing = unique_subjects['total'] - unique_subjects[folder]
+        if missing:
+            subjects_incomplete[folder] = sorted(missing)
+    subjects_incomplete = sorted(subjects_incomplete.items())
+
+    if not subjects_complete:
+        print('\nError: could not find subjects with data for all dates specified.')
+        sys.exit(1)
+
+    if subjects_incomplete:
+        print('\nWarning: the following subject(s) could not be found:')
+        for m in range(len(subjects_incomplete)):
+            folder = subjects_incomplete[m][0]
+            print('{}: {}'.format(folder,', '.join(subjects_incomplete[m][1])))
+        input('Press Enter to continue...')
+
+    print('\nThe following subjects were found:') #TODO: maybe print in columns?
+    for subject in subjects_complete:
+        print(subject)
     input('Press Enter to continue...')
 
-print('\nThe following subjects were found:') #TODO: maybe print in columns?
-for subject in subjects_complete:
-    print(subject)
-input('Press Enter to continue...')
-
-subjects = subjects_complete
-
-# Check first that all files exist (for folders, for subjects, for trials)
-non_existent_files = []
-for folder in folders:
-    for subject in subjects:
-        for trial in range(1,trials+1):
-            filename = 'data/{}/{}_{}_touches.txt'.format(folder,subject,str(trial).zfill(3))
-            if not os.path.isfile(filename):
-                non_existent_files.append(filename)
-if non_existent_files:
-    print('Error: the following file(s) could not be found:')
-    for f in non_existent_files:
-        print(f)
-    print('\n')
-    exit(1)
-
-# Assign groups to subjects
-groups = {}
-for subject in subjects:
-    groups[subject] = input('Assign group to {}: '.format(subject))
-
-print('\nAll ready to go!')
-input('Press Enter to continue...')
-print('\nProcessing...')
-
-# Make a logger that writes all warnings log.txt file
-def log(folder, subject, trial, msg):
-    output = '{}/{}_{}: {}'.format(folder, subject, str(trial).zfill(3), msg)
-    with open('data/{}_log.txt'.format(out),'a') as f:
-        f.write(output)
+    subjects = subjects_complete
 
-# Go through every file and add the summary statistics to summary.txt
-for folder in folders:
+    # Check first that all files exist (for folders, for subjects, for trials)
+    non_existent_files = []
+    for folder in folders:
+        for subject in subjects:
+            for trial in range(1,trials+1):
+                name = '{}_{:03d}_touches.txt'.format(subject,trial)
+                if name not in files_in_folder[folder]:
+                    non_existent_files.append('data/{}/{}'.format(folder,name))
+    if non_existent_files:
+        print('Error: the following file(s) could not be found:')
+        for f in non_existent_files:
+            print(f)
+        print('\n')
+        exit(1)
+
+    # Assign groups to subjects
+    groups = {}
     for subject in subjects:
+        groups[subject] = input('Assign group to {}: '.format(subject))
 
-        for trial in range(trials):
-            filename = 'data/{}/{}_{}_touches.txt'.format(folder,subject,str(trial+1).zfill(3))
-            # Read corresponding _touches.txt file
-            touches = np.array(np.genfromtxt(filename,delimiter=',',skip_header=1),ndmin=2)
-
-            # Calculate the means of the following for the number of trials per day:
-            # 1) total number of foot faults
-            # 2) total number of right-sided foot faults
-            # 3) total number of left-sided foot faults
-            # 4) traversion time
-            # 5) time to first foot fault
-            # 6) distance to first foot fault
-
-            # 1), 2), and 3): number of (lateralized) foot faults
-            unique, counts = np.unique(touches[:,1], return_counts=True)
-            right = 0
-            left = 0
-            summary = np.zeros((1,48))
-
-            for ch, count in zip(unique, counts):
-                summary[0,int(ch)] = count
-                if finish_ch < ch < start_ch and ch % 2 == 0: # If ch is even (and excluding the start & finish channels)
-                    right += count
-                elif finish_ch < ch < start_ch > 1 and ch % 2 == 1: # If ch is odd (and exluding the start & finish channels)
-                    left += count
-            total = left + right
-
-            # 4) Calculate the traversion time, by substracting the time of the last touch
-            # (finish_ch) from the first touch (start_ch)
+    print('\nAll ready to go!')
+    input('Press Enter to continue...')
+    print('\nProcessing...')
+
+    # Go through every file and collect the summary statistics for summary.txt.
+    # The files are read and summarized in parallel, but the results are kept
+    # in the same order as the files.
+    tasks = [(folder, subject, trial) for folder in folders for subject in subjects for trial in range(trials)]
+    # The start of each row (day, group, subject) is the same for all trials of
+    # a subject in a folder
+    row_starts = {(folder, subject): '{},{},{},'.format(folder, groups[subject], subject)
+        for folder in folders for subject in subjects}
+    summary_rows = ['day,group,subject,trial,total,left,right,trav_time,time_to_first,dist_to_first']
+    log_lines = []
+    with ProcessPoolExecutor() as executor:
+        chunksize = max(1, len(tasks) // (4 * (os.cpu_count() or 1)))
+        results = executor.map(summarize_trial, tasks, chunksize=chunksize)
+        for (folder, subject, trial), (stats, log_buf) in zip(tasks, results):
+            log_lines += log_buf
+            summary_rows.append('{}{},{}'.format(row_starts[folder, subject], trial+1, stats))
+
+    # Write both output files at once (any existing output file has been
+    # deleted above)
+    with open('data/{}.txt'.format(out),'w') as f:
+        f.write('\n'.join(summary_rows))
+    with open('data/{}_log.txt'.format(out),'a') as f:
+        f.write(''.join(log_lines))
+    print('\nSaved to /data/{}.txt'.format(out))
 
-            # Take the last touch recorded on start_ch
-            start_touches = touches[np.where(touches[:,1] == start_ch)]
-            if len(start_touches) == 0:
-                msg = 'No touch recorded on channel {}. Could not calculate traversion time.\n'.format(start_ch)
-                log(folder, subject, trial, msg)
-                trav_time = 'nan'
-                start_time = 'nan'
-            else:
-                # If there is at least one touch recorded on start_ch, take the last one
-                # and continue with the last touch recorded (on finish_ch)
-                start_time = start_touches[-1][2]
-
-                # Get all touches on finish_ch
-                finish_touches = touches[np.where(touches[:,1] == finish_ch)]
-                if len(finish_touches) == 0:
-                    msg = 'No touch recorded on channel {}. Could not calculate traversion time.\n'.format(finish_ch)
-                    log(folder, subject, trial, msg)
-                    trav_time = 'nan'
-                else:
-                    # If there is at least one touch recorded on finish_ch, take the
-                    # release time of the first one (= touch time + duration)
-                    finish_time = finish_touches[0][2] + finish_touches[0][3]
-
-                    # If another channel was touched after release of finish_ch
-                    # (perhaps by a tail or by the investigator):
-                    if finish_touches[-1,2] + finish_touches[-1,3] < touches[-1,2]:
-                        msg = 'At least one other channel was touched after channel {} was released. Calculation of traversion time may be incorrect.\n'.format(finish_ch)
-                        log(folder, subject, trial, msg)
-                    trav_time = str(finish_time - start_time)
-
-            # 5) and 6): Time and distance to first foot fault
-            if total != 0:# If there are any foot faults detected
-                foot_faults = touches[np.where(touches[:,1] < start_ch)]
-                foot_faults = foot_faults[np.where(foot_faults[:,1] > finish_ch)]
-                dist_to_first_fault = str(int(100 - (foot_faults[0,1] // 2) * 4))
-                if start_time != 'nan': # If start time was not recorded, time to first
-                # foot fault is not defined
-                    time_to_first_fault = str(foot_faults[0,2] - start_time)
-                    time_to_first_fault = str(Decimal(time_to_first_fault).quantize(Decimal('.001'), rounding=ROUND_HALF_UP))
-                else:
-                    time_to_first_fault = 'nan'
-            else:
-                time_to_first_fault = 'nan'
-                dist_to_first_fault = 'nan'
-
-            # Add the results to summary.txt file
-            summary_txt = '\n' + ','.join((folder,groups[subject],subject,str(trial+1),str(total),str(left),str(right),trav_time,time_to_first_fault,dist_to_first_fault))
-            if not os.path.isfile('data/{}.txt'.format(out)):
-                summary_txt = 'day,group,subject,trial,total,left,right,trav_time,time_to_first,dist_to_first' + summary_txt
-            with open('data/{}.txt'.format(out),'a') as f:
-                f.write(summary_txt)
-print('\nSaved to /data/{}.txt'.format(out))
+if __name__ == '__main__':
+    main()
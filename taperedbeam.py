@@ -2,9 +2,12 @@
 # Touch/release thresholds set at (4,2) in MPR121_edited.py
 # Always run this script with <sudo> to get access to the MPR121
 # Use Python 3 to access datetime.timestamp and datetime.fromtimestamp methods
+# For a higher sampling rate, run the I2C bus at 400 kHz instead of the default
+# 100 kHz by adding <dtparam=i2c_arm_baudrate=400000> to /boot/config.txt
 
 """This is the main script that acquires the data during a tapered beam trial.
-Add the -c or --camera option to simultaneously record video during the trial.
+Add the -c or --camera option to simultaneously record video during the trial,
+and the -v or --verbose option to print the touch status of every touch.
 Data collection can be stopped by pressing Ctrl-C.
 
 N.B.: conversion of video recording to .mp4 requires installation of gpac,
@@ -13,7 +16,7 @@ window.
 """
 
 # Import the necessary modules
-import sys, os, time, argparse, atexit
+import sys, os, time, argparse, atexit, signal, threading
 from datetime import datetime
 import RPi.GPIO as GPIO
 import Adafruit_MPR121.MPR121_edited as MPR121
@@ -23,6 +26,8 @@ import picamera
 parser = argparse.ArgumentParser()
 parser.add_argument('-c', '--camera', help = 'enable camera recording',
 action = "store_true")
+parser.add_argument('-v', '--verbose', help = 'print the touch status of each \
+sensor for every touch', action = "store_true")
 args = parser.parse_args()
 
 # Set the GPIO pin connected to the IRQ pins on the MPR121s
@@ -52,6 +57,7 @@ atexit.register(GPIO.cleanup)
 
 # Ask user for mouse ID and trial number to create corresponding text file in
 # /data/[currentdate]/
+invalid_chars = set('<>:"/|?*\\')
 while True:
     targetdir = 'data/' + datetime.now().strftime('%Y%m%d')
     os.makedirs(targetdir, mode=0o777, exist_ok=True)
@@ -59,16 +65,9 @@ while True:
     trial = input('Trial number: ').zfill(3)
     filename = '{}_{}_raw.txt'.format(mouse_id,trial)
 
-    invalid_chars = ('<>:"/|?*\\')
-
     # Check for invalid characters in the provided filename
-    try:
-        for char in invalid_chars:
-            if char in filename:
-                raise ValueError()
-    except ValueError:
+    if not invalid_chars.isdisjoint(filename):
         print('Invalid filename, please try again.')
-        pass
     else:
         pathname = targetdir + '/' + filename
         break
@@ -105,28 +104,65 @@ while try_clear > 0:
             print('One or more electrodes are being touched. Please check the touch sensors and try again.')
             sys.exit(1)
 
-def get_touches():
+# get_touches is called from both the main thread and the thread that runs the
+# RPi.GPIO callbacks. Only one of them at a time may read and save the touch
+# status, so that the rows in the data file stay in chronological order.
+touch_lock = threading.Lock()
 
-    # Read touch status from each sensor
-    touch1 = cap1.touched()
-    touch2 = cap2.touched()
-    touch3 = cap3.touched()
-    touch4 = cap4.touched()
+# Open the data file only once (it is closed at exit, also after Ctrl-C)
+raw_file = open(pathname, 'a')
 
-    # Print touch status from each sensor
-    print('cap1: ' + str(touch1).zfill(4)
-        + ', cap2: ' + str(touch2).zfill(4)
-        + ', cap3: ' + str(touch3).zfill(4)
-        + ', cap4: ' + str(touch4).zfill(4)
-        )
-
-    # Save touch status from each sensor
-    with open(pathname,'a') as f:
-        f.write(str(datetime.now().timestamp()) + ',' + str(touch1).zfill(4)
-        + ',' + str(touch2).zfill(4)
-        + ',' + str(touch3).zfill(4)
-        + ',' + str(touch4).zfill(4)
-        + '\n')
+# Close the data file when no touch status is being saved. A callback may still
+# be running after event detection has been stopped.
+def close_raw_file():
+    with touch_lock:
+        raw_file.close()
+
+atexit.register(close_raw_file)
+
+# Read and save the touch status of all sensors
+def get_touches():
+    with touch_lock:
+
+        # Data collection has already ended if the data file has been closed
+        if raw_file.closed:
+            return
+
+        # Read touch status from each sensor. Each read is a single I2C
+        # transaction on the shared bus, so its clock speed limits how fast
+        # this can be done (see the top of this script).
+        touch1 = cap1.touched()
+        touch2 = cap2.touched()
+        touch3 = cap3.touched()
+        touch4 = cap4.touched()
+
+        # Print touch status from each sensor (this slows down the sampling rate)
+        if args.verbose:
+            print('cap1: %04d, cap2: %04d, cap3: %04d, cap4: %04d' % (touch1, touch2, touch3, touch4))
+
+        # Save touch status from each sensor. Each row is flushed to the file
+        # right away, so that no data is lost if the script is killed or the
+        # power fails.
+        raw_file.write('%.6f,%04d,%04d,%04d,%04d\n' % (time.time(), touch1, touch2, touch3, touch4))
+        raw_file.flush()
+
+# Error that stopped data collection from within the interrupt callback (if any)
+collection_error = None
+
+# Callback for interrupts on the IRQ pin (RPi.GPIO passes the GPIO channel,
+# which is not used here). RPi.GPIO only prints exceptions raised in a callback
+# and carries on, so on an error (e.g. in I2C communication) stop data
+# collection here by interrupting the main thread, as if Ctrl-C was pressed.
+def on_interrupt(channel):
+    global collection_error
+    if collection_error is not None:
+        return
+    try:
+        get_touches()
+    except Exception as e:
+        collection_error = e
+        print('Error reading the touch sensors: {}. Stopping data collection.'.format(e))
+        os.kill(os.getpid(), signal.SIGINT)
 
 # Main program
 def main():
@@ -145,10 +181,16 @@ def main():
     # Record the start of data collection
     get_touches()
 
-    # Main loop, waiting for touches (signaled by interrupts) to occur
+    # Handle touches (signaled by interrupts) as soon as they occur, in a
+    # callback run by RPi.GPIO. The main thread just sleeps until Ctrl-C,
+    # rather than continuously polling for events.
+    GPIO.add_event_callback(26, on_interrupt)
+    # The IRQ pin stays low until the touch status is read, so read it again in
+    # case a touch occurred before the callback was added
+    if not GPIO.input(26):
+        get_touches()
     while True:
-        if GPIO.event_detected(26):
-            get_touches()
+        signal.pause()
 
     # Uncomment the lines below to save the filtered ADC values as well.
     # Note: this will slow down the sampling rate and only supports one MPR121
@@ -165,6 +207,8 @@ if __name__ == '__main__':
     try:
         main()
     except KeyboardInterrupt:
+        # Stop handling interrupts before the data file is closed at exit
+        GPIO.remove_event_detect(26)
         print('Done collecting data.')
 
         # If video was recorded, save it to .mp4 format and close the camera
@@ -175,3 +219,7 @@ if __name__ == '__main__':
             print('Video saved.')
             camera.close()
             os.remove(pathname[:-7] + 'vid.h264')
+
+        # Exit with an error status if data collection was stopped by an error
+        if collection_error is not None:
+            sys.exit(1)